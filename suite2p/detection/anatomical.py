@@ -2,15 +2,20 @@
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
 import numpy as np
+from collections import namedtuple
+from numba import njit
 from typing import Any, Dict
-from scipy.ndimage import find_objects, gaussian_filter
+from scipy.ndimage import gaussian_filter
 from cellpose.models import CellposeModel
 from cellpose import transforms, dynamics, core
 from cellpose.utils import fill_holes_and_remove_small_masks
 from cellpose.transforms import normalize99
 import time
+import contextlib
 import cv2
 import os
+import torch
+from concurrent.futures import ThreadPoolExecutor
 
 from . import utils
 from .stats import roi_stats
@@ -18,92 +23,227 @@ from .detect import select_rois
 
 
 def mask_centers(masks):
-    centers = np.zeros((masks.max(), 2), np.int32)
-    diams = np.zeros(masks.max(), np.float32)
-    slices = find_objects(masks)
-    for i, si in enumerate(slices):
-        if si is not None:
-            sr, sc = si
-            ymed, xmed, diam = utils.mask_stats(masks[sr, sc] == (i + 1))
-            centers[i] = np.array([ymed, xmed])
-            diams[i] = diam
+    """ centers and diameters of all masks, in one pass over the label image """
+    Ly, Lx = masks.shape
+    nmasks = masks.max()
+    labels = masks.ravel()
+    yy, xx = np.mgrid[:Ly, :Lx]
+    counts = np.bincount(labels, minlength=nmasks + 1)[1:]
+    sy = np.bincount(labels, weights=yy.ravel(), minlength=nmasks + 1)[1:]
+    sx = np.bincount(labels, weights=xx.ravel(), minlength=nmasks + 1)[1:]
+    counts_nz = np.maximum(1, counts)
+    centers = np.stack((sy / counts_nz, sx / counts_nz), axis=1).astype(np.int32)
+    diams = (2. * (counts / np.pi)**0.5).astype(np.float32)
     return centers, diams
 
 
+_MODEL_CACHE = {}
+
+
+def _get_model(pretrained_model, gpu):
+    """ construct a CellposeModel once per (pretrained_model, gpu) per process """
+    key = (pretrained_model, gpu)
+    model = _MODEL_CACHE.get(key)
+    if model is None:
+        model = (CellposeModel(gpu=gpu) if pretrained_model is None else
+                 CellposeModel(pretrained_model=pretrained_model, gpu=gpu))
+        _MODEL_CACHE[key] = model
+    return model
+
+
+def _asnumpy(x):
+    """ move a network output (numpy / torch / mxnet) to a numpy array """
+    if isinstance(x, np.ndarray):
+        return x
+    try:
+        return x.asnumpy()
+    except AttributeError:
+        return x.detach().cpu().numpy()
+
+
+def _postprocess_batch(pmasks, j, cellprob, dP, flows_in, niter, ly):
+    """ CPU post-processing for one patch_detect batch: flow following,
+    mask assembly, hole filling and resize back to the patch size """
+    maskis = []
+    for i in range(cellprob.shape[0]):
+        pi = dynamics.follow_flows(flows_in[i], niter=niter)
+        maski = dynamics.get_masks(pi, iscell=(cellprob[i] > 0), flows=dP[i],
+                                   threshold=1.0)
+        maskis.append(maski)
+    maskb = np.stack(
+        [fill_holes_and_remove_small_masks(maski) for maski in maskis])
+    # resize the whole batch with one nearest-neighbor call and one write
+    maskb = torch.from_numpy(maskb.astype(np.float32))
+    maskb = torch.nn.functional.interpolate(maskb.unsqueeze(1), size=(ly, ly),
+                                            mode="nearest").squeeze(1)
+    pmasks[j:j + maskb.shape[0]] = maskb.numpy().astype(np.uint16)
+
+
 def patch_detect(patches, diam):
     """ anatomical detection of masks from top active frames for putative cell """
     print("refining masks using cellpose")
     npatches = len(patches)
     ly = patches[0].shape[0]
-    model = CellposeModel(gpu=True if core.use_gpu() else False)
+    model = _get_model(None, True if core.use_gpu() else False)
     imgs = np.zeros((npatches, ly, ly, 2), np.float32)
-    for i, m in enumerate(patches):
-        imgs[i, :, :, 0] = transforms.normalize99(m)
+    arr = np.stack(patches).astype(np.float32)
+    # both percentiles of every patch in one batched partition instead of a
+    # normalize99 call (two percentile sorts) per patch
+    lo, hi = np.quantile(arr.reshape(npatches, -1), [0.01, 0.99], axis=1)
+    imgs[:, :, :, 0] = ((arr - lo[:, np.newaxis, np.newaxis]) /
+                        (hi - lo)[:, np.newaxis, np.newaxis])
     rsz = 30. / diam
     imgs = transforms.resize_image(imgs, rsz=rsz).transpose(0, 3, 1, 2)
     imgs, ysub, xsub = transforms.pad_image_ND(imgs)
+    use_fp16 = True if core.use_gpu() else False
 
     pmasks = np.zeros((npatches, ly, ly), np.uint16)
-    batch_size = 8 * 224 // ly
+    if core.use_gpu() and torch.cuda.is_available():
+        # size batches from free GPU memory so small patches don't leave the
+        # GPU under-filled; ~64x the input footprint is a conservative bound
+        # on the network activations per image
+        free_bytes = torch.cuda.mem_get_info()[0]
+        batch_size = int(np.clip((free_bytes // 2) // (imgs[0].nbytes * 64), 1, 32))
+    else:
+        batch_size = max(1, 8 * 224 // ly)
     tic = time.time()
-    for j in np.arange(0, npatches, batch_size):
-        # Maintain compatibility with both Cellpose 3 and 4
-        # Use try-except instead of hasattr for Numba compatibility
-        try:
-            # Try Cellpose 4 first
-            y = model.net(imgs[j:j + batch_size])[0]
-        except AttributeError:
-            try:
-                # Try Cellpose 3
-                y = model.cp.network(imgs[j:j + batch_size])[0]
-            except AttributeError:
-                raise AttributeError("Could not find network attribute in Cellpose model - unsupported Cellpose version")
-        
-        y = y[:, :, ysub[0]:ysub[-1] + 1, xsub[0]:xsub[-1] + 1]
-        y = y.asnumpy()
-        for i, yi in enumerate(y):
-            cellprob = yi[-1]
-            dP = yi[:2]
+    # one worker overlaps the CPU post-processing of the previous batch with
+    # the next batch's forward pass; batches write disjoint pmasks slices
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for j in np.arange(0, npatches, batch_size):
+            amp = (torch.autocast("cuda", dtype=torch.float16)
+                   if use_fp16 else contextlib.nullcontext())
+            X = imgs[j:j + batch_size]
+            if use_fp16:
+                # cast to half on the host so the transfer moves half the
+                # bytes, then run the net on the device tensor under autocast
+                X = torch.from_numpy(X).to(torch.float16).to(model.device)
+            # Maintain compatibility with both Cellpose 3 and 4
+            # Use try-except instead of hasattr for Numba compatibility
+            with amp:
+                try:
+                    # Try Cellpose 4 first
+                    y = model.net(X)[0]
+                except AttributeError:
+                    try:
+                        # Try Cellpose 3
+                        y = model.cp.network(X)[0]
+                    except AttributeError:
+                        raise AttributeError("Could not find network attribute in Cellpose model - unsupported Cellpose version")
+
+            if use_fp16:
+                # flow post-processing stays in float32
+                y = y.float() if torch.is_tensor(y) else y.astype(np.float32)
+            y = y[:, :, ysub[0]:ysub[-1] + 1, xsub[0]:xsub[-1] + 1]
+            cellprob = y[:, -1]
+            dP = y[:, :2]
             niter = 1 / rsz * 200
-            p = dynamics.follow_flows(-1 * dP * (cellprob > 0) / 5., niter=niter)
-            maski = dynamics.get_masks(p, iscell=(cellprob > 0), flows=dP,
-                                       threshold=1.0)
-            maski = fill_holes_and_remove_small_masks(maski)
-            maski = transforms.resize_image(maski, ly, ly,
-                                            interpolation=cv2.INTER_NEAREST)
-            pmasks[j + i] = maski
-        if j % 5 == 0:
-            print("%d / %d masks created in %0.2fs" %
-                  (j + batch_size, npatches, time.time() - tic))
+            # mask and scale the flows for the whole batch in one vectorized
+            # op, while the network output is still on the device
+            flows_in = -1 * dP * (cellprob[:, None] > 0) / 5.
+            # one DtoH transfer per batch instead of per patch
+            cellprob = _asnumpy(cellprob)
+            dP = _asnumpy(dP)
+            flows_in = _asnumpy(flows_in)
+            if pending is not None:
+                pending.result()
+            pending = executor.submit(_postprocess_batch, pmasks, j, cellprob, dP,
+                                      flows_in, niter, ly)
+            if j % 5 == 0:
+                print("%d / %d masks created in %0.2fs" %
+                      (j + batch_size, npatches, time.time() - tic))
+        if pending is not None:
+            pending.result()
     return pmasks
 
 
+@njit
+def _refine_one(patch_mask, func_mask, y0, y1, x0, x1):
+    """ match patch labels to the binary functional mask and extract the winner
+
+    the functional mask is a single binary mask, so the IoU with each patch
+    label reduces to per-label pixel counts accumulated in one pass
+    """
+    n = int(patch_mask.max()) + 1
+    area = np.zeros(n, np.int64)
+    inter = np.zeros(n, np.int64)
+    nfunc = 0
+    Ny, Nx = patch_mask.shape
+    for y in range(Ny):
+        for x in range(Nx):
+            lbl = patch_mask[y, x]
+            area[lbl] += 1
+            if func_mask[y, x] > 0:
+                nfunc += 1
+                inter[lbl] += 1
+    best = 0
+    best_iou = 0.
+    for lbl in range(1, n):
+        denom = area[lbl] + nfunc - inter[lbl]
+        iou = inter[lbl] / denom if denom > 0 else 0.
+        if iou > best_iou:
+            best_iou = iou
+            best = lbl
+    if best == 0 or best_iou <= 0.45:
+        return (np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(
+            0, np.float32), False)
+    npix = 0
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            if patch_mask[y, x] == best:
+                npix += 1
+    ypix = np.zeros(npix, np.int64)
+    xpix = np.zeros(npix, np.int64)
+    lam = np.zeros(npix, np.float32)
+    k = 0
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            if patch_mask[y, x] == best:
+                ypix[k] = y - y0
+                xpix[k] = x - x0
+                lam[k] = func_mask[y, x]
+                k += 1
+    return ypix, xpix, lam, True
+
+
 def refine_masks(stats, patches, seeds, diam, Lyc, Lxc):
     nmasks = len(patches)
     patch_masks = patch_detect(patches, diam)
     ly = patches[0].shape[0] // 2
+    # crop-window bounds and offsets for all ROIs at once
+    seeds = np.asarray(seeds)
+    ys0 = np.maximum(0, ly - seeds[:, 0])
+    ys1 = np.minimum(2 * ly, Lyc + ly - seeds[:, 0])
+    xs0 = np.maximum(0, ly - seeds[:, 1])
+    xs1 = np.minimum(2 * ly, Lxc + ly - seeds[:, 1])
+    yoff = np.maximum(0, seeds[:, 0] - ly)
+    xoff = np.maximum(0, seeds[:, 1] - ly)
+    # gather the per-ROI pixel arrays into flat SoA arrays once, so the loop
+    # reads contiguous slices instead of chasing per-dict arrays
+    offs = np.zeros(nmasks + 1, np.int64)
+    offs[1:] = np.cumsum([len(stats[i]["ypix"]) for i in range(nmasks)])
+    ypix_flat = np.concatenate([stats[i]["ypix"] for i in range(nmasks)])
+    xpix_flat = np.concatenate([stats[i]["xpix"] for i in range(nmasks)])
+    lam_flat = np.concatenate([stats[i]["lam"] for i in range(nmasks)])
     igood = np.zeros(nmasks, "bool")
     for i, (patch_mask, stat, (yi, xi)) in enumerate(zip(patch_masks, stats, seeds)):
-        mask = np.zeros((Lyc, Lxc), np.float32)
-        ypix0, xpix0 = stat["ypix"], stat["xpix"]
-        mask[ypix0, xpix0] = stat["lam"]
-        func_mask = utils.square_mask(mask, ly, yi, xi)
-        ious = utils.mask_ious(patch_mask.astype(np.uint16), (func_mask
-                                                              > 0).astype(np.uint16))[0]
-        if len(ious) > 0 and ious.max() > 0.45:
-            mask_id = np.argmax(ious) + 1
-            patch_mask = patch_mask[max(0, ly - yi):min(2 * ly, Lyc + ly - yi),
-                                    max(0, ly - xi):min(2 * ly, Lxc + ly - xi)]
-            func_mask = func_mask[max(0, ly - yi):min(2 * ly, Lyc + ly - yi),
-                                  max(0, ly - xi):min(2 * ly, Lxc + ly - xi)]
-            ypix0, xpix0 = np.nonzero(patch_mask == mask_id)
-            lam0 = func_mask[ypix0, xpix0]
+        i0, i1 = offs[i], offs[i + 1]
+        # scatter the sparse ROI pixels straight into the 2ly x 2ly square
+        # window instead of zeroing and cropping a full Lyc x Lxc frame
+        func_mask = np.zeros((2 * ly, 2 * ly), np.float32)
+        ys_rel = ypix_flat[i0:i1] - (yi - ly)
+        xs_rel = xpix_flat[i0:i1] - (xi - ly)
+        inside = ((ys_rel >= 0) & (ys_rel < 2 * ly) & (xs_rel >= 0) &
+                  (xs_rel < 2 * ly))
+        func_mask[ys_rel[inside], xs_rel[inside]] = lam_flat[i0:i1][inside]
+        ypix0, xpix0, lam0, good = _refine_one(patch_mask, func_mask, ys0[i], ys1[i],
+                                               xs0[i], xs1[i])
+        if good:
             lam0[lam0 <= 0] = lam0.min()
-            ypix0 = ypix0 + max(0, yi - ly)
-            xpix0 = xpix0 + max(0, xi - ly)
             igood[i] = True
-            stat["ypix"] = ypix0
-            stat["xpix"] = xpix0
+            stat["ypix"] = ypix0 + yoff[i]
+            stat["xpix"] = xpix0 + xoff[i]
             stat["lam"] = lam0
             stat["anatomical"] = True
         else:
@@ -112,12 +252,12 @@ def refine_masks(stats, patches, seeds, diam, Lyc, Lxc):
 
 
 def roi_detect(ops, mproj, mov, diameter=None, cellprob_threshold=0.0, flow_threshold=0.4,
-               pretrained_model=None):
+               pretrained_model=None, mean_img=None, max_proj=None):
     pretrained_model = "cpsam" if pretrained_model is None else pretrained_model
     # If diameter is 0, set to None for Cellpose automatic estimation
     if diameter == 0:
         diameter = None
-    model = CellposeModel(pretrained_model=pretrained_model, gpu=True if core.use_gpu() else False)
+    model = _get_model(pretrained_model, True if core.use_gpu() else False)
     # Call model.eval and handle both 3 and 4 return values for compatibility
     eval_result = model.eval(mproj, diameter=diameter,
                        cellprob_threshold=cellprob_threshold,
@@ -132,11 +272,18 @@ def roi_detect(ops, mproj, mov, diameter=None, cellprob_threshold=0.0, flow_thre
     else:
         masks, flows, styles = eval_result
         print(f"Estimating diameter from activity-based detection")
-        median_diam = estimate_diameter_from_activity(ops, mov)
+        median_diam = estimate_diameter_from_activity(ops, mov, mean_img=mean_img,
+                                                      max_proj=max_proj)
     
-    shape = masks.shape
-    _, masks = np.unique(np.int32(masks), return_inverse=True)
-    masks = masks.reshape(shape)
+    masks = np.asarray(masks)
+    if masks.dtype.kind not in "iu":
+        masks = np.int32(masks)
+    # relabel to 0...N with a bincount LUT instead of sorting via np.unique
+    counts = np.bincount(masks.ravel())
+    present = np.flatnonzero(counts)
+    lut = np.zeros(counts.size, np.int32)
+    lut[present] = np.arange(present.size, dtype=np.int32)
+    masks = lut[masks]
     centers, mask_diams = mask_centers(masks)
     if median_diam is not None:
         print(">>>> %d masks detected, median diameter = %0.2f " %
@@ -147,57 +294,94 @@ def roi_detect(ops, mproj, mov, diameter=None, cellprob_threshold=0.0, flow_thre
     return masks, centers, median_diam, mask_diams.astype(np.int32)
 
 
+# structure-of-arrays ROI stats: flat per-pixel arrays with ROI i occupying
+# slice offsets[i]:offsets[i+1]; med is (nmasks, 2) and footprint/anatomical
+# are per-ROI vectors
+_StatsSoA = namedtuple("_StatsSoA",
+                       ["ypix", "xpix", "lam", "offsets", "med", "footprint",
+                        "anatomical"])
+
+
+def stats_to_list(stats):
+    """ convert _StatsSoA to the list-of-dicts format used downstream """
+    nmasks = len(stats.offsets) - 1
+    stats_list = []
+    for i in range(nmasks):
+        i0, i1 = stats.offsets[i], stats.offsets[i + 1]
+        stats_list.append({
+            "ypix": stats.ypix[i0:i1],
+            "xpix": stats.xpix[i0:i1],
+            "lam": stats.lam[i0:i1],
+            "med": [stats.med[i, 0], stats.med[i, 1]],
+            "footprint": stats.footprint[i]
+        })
+    return np.array(stats_list)
+
+
 def masks_to_stats(masks, weights):
-    stats = []
-    slices = find_objects(masks)
-    for i, si in enumerate(slices):
-        sr, sc = si
-        ypix0, xpix0 = np.nonzero(masks[sr, sc] == (i + 1))
-        ypix0 = ypix0.astype(int) + sr.start
-        xpix0 = xpix0.astype(int) + sc.start
+    """ stats of all masks as a _StatsSoA (see stats_to_list for dicts) """
+    nmasks = masks.max()
+    Lx = masks.shape[1]
+    # group pixels by label with a single stable argsort instead of
+    # scanning the full mask once per ROI
+    flat = masks.ravel()
+    order = np.argsort(flat, kind="stable")
+    sorted_labels = flat[order]
+    edges = np.searchsorted(sorted_labels, np.arange(1, nmasks + 2))
+    ys, xs = np.divmod(order[edges[0]:], Lx)
+    lam_all = weights[ys, xs]
+    offsets = edges - edges[0]
+    med = np.zeros((nmasks, 2), np.int64)
+    for i in range(nmasks):
+        i0, i1 = offsets[i], offsets[i + 1]
+        ypix0, xpix0 = ys[i0:i1], xs[i0:i1]
         ymed = np.median(ypix0)
         xmed = np.median(xpix0)
         imin = np.argmin((xpix0 - xmed)**2 + (ypix0 - ymed)**2)
-        xmed = xpix0[imin]
-        ymed = ypix0[imin]
-        stats.append({
-            "ypix": ypix0,
-            "xpix": xpix0,
-            "lam": weights[ypix0, xpix0],
-            "med": [ymed, xmed],
-            "footprint": 1
-        })
-    stats = np.array(stats)
-    return stats
+        med[i, 0] = ypix0[imin]
+        med[i, 1] = xpix0[imin]
+    return _StatsSoA(ypix=ys, xpix=xs, lam=lam_all, offsets=offsets, med=med,
+                     footprint=np.ones(nmasks, np.int32),
+                     anatomical=np.zeros(nmasks, "bool"))
 
 
-def select_rois(ops: Dict[str, Any], mov: np.ndarray, diameter=None):
+def select_rois(ops: Dict[str, Any], mov: np.ndarray, diameter=None, mean_img=None,
+                max_proj=None, hp_mov=None):
     """ find ROIs in static frames
-    
+
     Parameters:
 
         ops: dictionary
             requires keys "high_pass", "anatomical_only", optional "yrange", "xrange"
-        
+
         mov: ndarray t x Lyc x Lxc, binned movie
-    
+
+        mean_img, max_proj, hp_mov: optional precomputed projections and
+            high-pass-filtered movie, to avoid a second pass over mov when
+            select_rois is re-entered (e.g. for activity-based diameter estimation)
+
     Returns:
         stats: list of dicts
-    
+
     """
     Lyc, Lxc = mov.shape[1:]
-    mean_img = mov.mean(axis=0)
-    mov = utils.temporal_high_pass_filter(mov=mov, width=int(ops["high_pass"]))
-    max_proj = mov.max(axis=0)
+    if hp_mov is None:
+        mov, mean_img, max_proj = utils.compute_projections(
+            mov, width=int(ops["high_pass"]))
+    else:
+        mov = hp_mov
+        if mean_img is None:
+            mean_img = mov.mean(axis=0)
+        if max_proj is None:
+            max_proj = mov.max(axis=0)
     #max_proj = np.percentile(mov, 90, axis=0) #.mean(axis=0)
     if ops["anatomical_only"] == 1:
         img = np.log(np.maximum(1e-3, max_proj / np.maximum(1e-3, mean_img)))
         weights = max_proj
     elif ops["anatomical_only"] == 2:
         img = mean_img
-        weights = 0.1 + np.clip(
-            (mean_img - np.percentile(mean_img, 1)) /
-            (np.percentile(mean_img, 99) - np.percentile(mean_img, 1)), 0, 1)
+        lo, hi = np.quantile(mean_img, [0.01, 0.99])
+        weights = 0.1 + np.clip((mean_img - lo) / (hi - lo), 0, 1)
     elif ops["anatomical_only"] == 3:
         if "meanImgE" in ops:
             img = ops["meanImgE"][ops["yrange"][0]:ops["yrange"][1],
@@ -205,9 +389,8 @@ def select_rois(ops: Dict[str, Any], mov: np.ndarray, diameter=None):
         else:
             img = mean_img
             print("no enhanced mean image, using mean image instead")
-        weights = 0.1 + np.clip(
-            (mean_img - np.percentile(mean_img, 1)) /
-            (np.percentile(mean_img, 99) - np.percentile(mean_img, 1)), 0, 1)
+        lo, hi = np.quantile(mean_img, [0.01, 0.99])
+        weights = 0.1 + np.clip((mean_img - lo) / (hi - lo), 0, 1)
     else:
         img = max_proj.copy()
         weights = max_proj
@@ -232,17 +415,23 @@ def select_rois(ops: Dict[str, Any], mov: np.ndarray, diameter=None):
             "!NOTE! diameter set to 0 or None, diameter will be estimated by cellpose if possible")
 
     if ops.get("spatial_hp_cp", 0):
-        img = np.clip(normalize99(img), 0, 1)
-        img -= gaussian_filter(img, diameter[1] * ops["spatial_hp_cp"])
+        # float32 in, preallocated output and in-place subtract to avoid the
+        # float64 temporaries scipy would otherwise allocate
+        img = np.ascontiguousarray(np.clip(normalize99(img), 0, 1), dtype=np.float32)
+        img_blur = np.empty_like(img)
+        gaussian_filter(img, sigma=diameter[1] * ops["spatial_hp_cp"],
+                        output=img_blur, mode="reflect")
+        np.subtract(img, img_blur, out=img)
 
     masks, centers, median_diam, mask_diams = roi_detect(
         ops, img, mov, diameter=diameter[1], flow_threshold=ops["flow_threshold"],
         cellprob_threshold=ops["cellprob_threshold"],
-        pretrained_model=ops["pretrained_model"])
+        pretrained_model=ops["pretrained_model"], mean_img=mean_img,
+        max_proj=max_proj)
     if rescale != 1.0:
         masks = cv2.resize(masks, (Lxc, Lyc), interpolation=cv2.INTER_NEAREST)
         img = cv2.resize(img, (Lxc, Lyc))
-    stats = masks_to_stats(masks, weights)
+    stats = stats_to_list(masks_to_stats(masks, weights))
     print("Detected %d ROIs, %0.2f sec" % (len(stats), time.time() - t0))
 
     new_ops = {
@@ -260,15 +449,18 @@ def select_rois(ops: Dict[str, Any], mov: np.ndarray, diameter=None):
     return stats
 
 
-def estimate_diameter_from_activity(ops, mov):
+def estimate_diameter_from_activity(ops, mov, mean_img=None, max_proj=None):
     """Estimate diameter using activity-based detection (anatomical_only == 0)."""
-    
-    
+
+
     ops_copy = ops.copy()
     ops_copy["anatomical_only"] = 0
     try:
-        # Use the full movie for activity-based detection
-        stat = select_rois(ops_copy, mov)
+        # Use the full movie for activity-based detection; mov is already
+        # high-pass filtered by the outer select_rois, so pass it (and any
+        # precomputed projections) through rather than filtering again
+        stat = select_rois(ops_copy, mov, mean_img=mean_img, max_proj=max_proj,
+                           hp_mov=mov)
         if len(stat) > 0:
             # Estimate diameter for each ROI
             diams = []